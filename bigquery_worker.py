@@ -1,19 +1,108 @@
+import asyncio
+import atexit
+import functools
+import io
 import logging
-from textwrap import dedent
+import threading
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
+import cachetools
 import numpy as np
 import pandas as pd
-from google.cloud import bigquery
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from google.cloud import bigquery, bigquery_storage
 from google.cloud.exceptions import Conflict, NotFound
 
+BQ_TYPE_MAP = {
+    np.dtype('object'): 'STRING',
+    np.dtype('int32'): 'INTEGER',
+    np.dtype('int64'): 'INTEGER',
+    np.dtype('float64'): 'FLOAT',
+    np.dtype('datetime64[ns]'): 'DATE',
+}
+
+DTYPE_MAP = {
+    'STRING': np.dtype('object'),
+    'INTEGER': np.dtype('int64'),
+    'FLOAT': np.dtype('float64'),
+    'DATE': np.dtype('datetime64[ns]'),
+}
+
+ARROW_TYPE_MAP = {
+    'STRING': pa.string(),
+    'INTEGER': pa.int64(),
+    'FLOAT': pa.float64(),
+    'DATE': pa.date32(),
+}
+
+
+# flush_daily_info 를 호출하지 않고 종료해도 버퍼에 남은 행이 저장되도록 종료 시점에 비운다
+# 버퍼가 빌 때까지는 worker 가 GC 되어 행이 사라지지 않도록 강한 참조로 잡아 둔다
+_buffered_workers = set()
+
+
+@atexit.register
+def _flush_buffered_workers():
+    for worker in list(_buffered_workers):
+        worker.flush_daily_info()
+
 
 class BigqueryWorker:
+    max_workers = 16
+    union_tables_per_query = 50
+    flush_rows_threshold = 500000
+    project = 'storm-0809'
+    location = 'asia-northeast3'
+
+    # 클라이언트 생성(인증, 채널 설정)은 비용이 크므로 인스턴스 간에 공유한다.
+    # bigquery.Client 와 bigquery_storage 클라이언트는 모두 thread-safe 하다.
+    _client_cache = dict()
+    _client_cache_lock = threading.Lock()
+
     def __init__(self, app=None):
         self.logger = app.logger if app else logging.getLogger()
-        self.client = bigquery.Client(project='storm-0809', location='asia-northeast3')
-        self.dataset_ref = self.client.dataset('stock')
+        self.client, self.bqstorage_client = self._get_clients(self.project, self.location)
+        self.dataset_ref = bigquery.DatasetReference(self.client.project, 'stock')
+        self._table_cache = cachetools.TTLCache(maxsize=1024, ttl=300)
+        self._table_names_cache = cachetools.TTLCache(maxsize=1, ttl=60)
+        self._migrated_items_cache = cachetools.TTLCache(maxsize=16, ttl=60)
+        self._dtypes_cache = cachetools.LRUCache(maxsize=1024)
+        self._cache_lock = threading.Lock()
+        self._daily_info_buffers = dict()
+        self._buffer_lock = threading.Lock()
+        self._migrate_lock = threading.Lock()
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def _get_clients(cls, project, location):
+        with cls._client_cache_lock:
+            key = (project, location)
+            if key not in cls._client_cache:
+                cls._client_cache[key] = (
+                    bigquery.Client(project=project, location=location),
+                    bigquery_storage.BigQueryReadClient(),
+                )
+
+            return cls._client_cache[key]
 
     def get_table_if_exists(self, table_name):
+        with self._cache_lock:
+            if table_name in self._table_cache:
+                return self._table_cache[table_name]
+        table = self._get_table_uncached(table_name)
+        # 없는 테이블은 다른 프로세스가 곧 만들 수 있으므로 캐시하지 않는다
+        if table is not None:
+            with self._cache_lock:
+                self._table_cache[table_name] = table
+
+        return table
+
+    def _get_table_uncached(self, table_name):
         table_ref = bigquery.TableReference(self.dataset_ref, table_name)
         try:
             table = self.client.get_table(table_ref)
@@ -22,9 +111,28 @@ class BigqueryWorker:
         else:
             return table
 
-    def get_itemcodes_info(self):
+    def _list_table_names(self):
+        with self._cache_lock:
+            if 'table_names' in self._table_names_cache:
+                return self._table_names_cache['table_names']
+        table_names = {x.table_id for x in self.client.list_tables(self.dataset_ref)}
+        with self._cache_lock:
+            self._table_names_cache['table_names'] = table_names
+
+        return table_names
+
+    def _invalidate_table_cache(self, table_name):
+        with self._cache_lock:
+            self._table_cache.pop(table_name, None)
+            self._table_names_cache.clear()
+
+    def get_itemcodes_info(self, columns=None):
         table = self.get_table_if_exists('itemcodes_info')
-        df = self.client.list_rows(table).to_dataframe(dtypes=self._extract_dtypes(table))
+        dtypes = self._extract_dtypes(table, columns)
+        selected_fields = [x for x in table.schema if x.name in columns] if columns else None
+        dfs = self.client.list_rows(table, selected_fields=selected_fields).to_dataframe_iterable(
+            bqstorage_client=self.bqstorage_client, dtypes=dtypes)
+        df = self._concat_dataframes(dfs, dtypes)
         return df
 
     def save_itemcodes_info(self, df, write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE):
@@ -33,164 +141,587 @@ class BigqueryWorker:
 
         return table_ref
 
-    def get_daily_item_info(self, itemcode_info, start_date=None, end_date=None):
-        return self._get_daily_info('daily_items', itemcode_info, start_date, end_date)
+    def get_daily_item_info(self, itemcode_info, start_date=None, end_date=None, columns=None):
+        return self._get_daily_info('daily_items', itemcode_info, start_date, end_date, columns)
 
     def save_daily_item_info(self, itemcode_info, df, write_disposition=bigquery.WriteDisposition.WRITE_EMPTY):
-        itemcode, itemname, market = itemcode_info
-        table_name = f'daily_items_info_{itemcode}_{market}'
-        table_ref = self._save_info('daily_items', table_name, df, write_disposition)
+        return self._buffer_daily_info('daily_items', itemcode_info, df, write_disposition)
 
-        return table_ref
-
-    def get_daily_item_indicator_info(self, itemcode_info, start_date=None, end_date=None):
-        return self._get_daily_info('daily_items_indicator', itemcode_info, start_date, end_date)
+    def get_daily_item_indicator_info(self, itemcode_info, start_date=None, end_date=None, columns=None):
+        return self._get_daily_info('daily_items_indicator', itemcode_info, start_date, end_date, columns)
 
     def save_daily_item_indicator_info(
             self, itemcode_info, df, write_disposition=bigquery.WriteDisposition.WRITE_EMPTY):
-        itemcode, itemname, market = itemcode_info
-        table_name = f'daily_items_indicator_info_{itemcode}_{market}'
-        table_ref = self._save_info('daily_items_indicator', table_name, df, write_disposition)
+        return self._buffer_daily_info('daily_items_indicator', itemcode_info, df, write_disposition)
 
-        return table_ref
+    async def get_daily_item_info_async(self, itemcode_info, start_date=None, end_date=None, columns=None):
+        return await self._run_in_thread(self.get_daily_item_info, itemcode_info, start_date, end_date, columns)
+
+    async def save_daily_item_info_async(
+            self, itemcode_info, df, write_disposition=bigquery.WriteDisposition.WRITE_EMPTY):
+        return await self._run_in_thread(self.save_daily_item_info, itemcode_info, df, write_disposition)
+
+    async def get_daily_item_indicator_info_async(self, itemcode_info, start_date=None, end_date=None, columns=None):
+        return await self._run_in_thread(
+            self.get_daily_item_indicator_info, itemcode_info, start_date, end_date, columns)
+
+    async def save_daily_item_indicator_info_async(
+            self, itemcode_info, df, write_disposition=bigquery.WriteDisposition.WRITE_EMPTY):
+        return await self._run_in_thread(
+            self.save_daily_item_indicator_info, itemcode_info, df, write_disposition)
+
+    async def flush_daily_info_async(self):
+        return await self._run_in_thread(self.flush_daily_info)
+
+    async def _run_in_thread(self, func, *args):
+        # python 3.7 환경이라 asyncio.to_thread 대신 run_in_executor 사용
+        # python 3.7 의 Semaphore 는 생성 시점의 loop 에 묶이므로 loop 마다 따로 만든다
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_workers)
+        async with semaphore:
+            return await loop.run_in_executor(None, functools.partial(func, *args))
+
+    def flush_daily_info(self, info_type=None):
+        with self._buffer_lock:
+            keys = [x for x in self._daily_info_buffers if info_type is None or x[0] == info_type]
+            buffers = {key: self._daily_info_buffers.pop(key) for key in keys}
+        self._flush_daily_info_buffers(buffers)
+
+    def _flush_daily_info_buffers(self, buffers):
+        table_refs = []
+        try:
+            for key in list(buffers):
+                info_type, write_disposition = key
+                table_refs.append(self._flush_daily_info(info_type, buffers[key], write_disposition))
+                del buffers[key]
+        finally:
+            # 저장하지 못한 행은 다음 flush 때 다시 저장되도록 버퍼 앞쪽에 되돌려 놓는다
+            with self._buffer_lock:
+                for key, dfs in buffers.items():
+                    self._daily_info_buffers[key] = dfs + self._daily_info_buffers.get(key, [])
+                if not self._daily_info_buffers:
+                    _buffered_workers.discard(self)
+
+        return table_refs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush_daily_info()
 
     def get_last_date_of_daily_info(self, table_name, codeinfo_df=None):
+        self.flush_daily_info(table_name.split('_info')[0])
         itemnames_clause=''
+        query_parameters = []
         if codeinfo_df is not None:
-            itemnames_str = ', '.join([f"'{x}'" for x in codeinfo_df['itemname'].unique().tolist()])
-            itemnames_clause = f"WHERE itemname in ({itemnames_str})"
-        sql = dedent(f"""
-            SELECT MAX(date) lastdate
-            FROM stock.{table_name}
-            {itemnames_clause}
-        """)
-        df = self.client.query(sql).to_dataframe(dtypes={'lastdate': np.dtype('datetime64[ns]')})
-        lastdate = df.lastdate[0]
+            itemnames_clause = "WHERE itemname IN UNNEST(@itemnames)"
+            query_parameters.append(bigquery.ArrayQueryParameter(
+                'itemnames', 'STRING', codeinfo_df['itemname'].unique().tolist()))
+        sql = f"SELECT MAX(date) lastdate FROM stock.{table_name} {itemnames_clause}"
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters, use_query_cache=True)
+        rows = self.client.query_and_wait(sql, job_config=job_config, max_results=1)
+        lastdate = pd.Timestamp(next(iter(rows)).lastdate)
 
         return lastdate
 
-    def get_daily_info_all(self, info_type, codeinfo_df=None, start_date=None, end_date=None):
+    def get_daily_info_all(self, info_type, codeinfo_df=None, start_date=None, end_date=None, columns=None):
+        table = self.get_table_if_exists(info_type)
+        dfs = self.get_daily_info_all_iter(info_type, codeinfo_df, start_date, end_date, columns)
+        df = self._concat_dataframes(dfs, self._extract_dtypes(table, columns))
+
+        return df
+
+    def get_daily_info_all_iter(self, info_type, codeinfo_df=None, start_date=None, end_date=None, columns=None):
         wheres = []
+        query_parameters = []
         if codeinfo_df is not None and not codeinfo_df.empty:
-            item_names = ', '.join([f"'{x}'" for x in codeinfo_df['itemname']])
-            wheres.append(f"itemname IN ({item_names})")
+            wheres.append("itemname IN UNNEST(@itemnames)")
+            query_parameters.append(bigquery.ArrayQueryParameter(
+                'itemnames', 'STRING', codeinfo_df['itemname'].unique().tolist()))
         if start_date:
-            wheres.append(f"date >= '{start_date.format('YYYY-MM-DD')}'")
+            wheres.append("date >= @start")
+            query_parameters.append(bigquery.ScalarQueryParameter('start', 'DATE', start_date.format('YYYY-MM-DD')))
         if end_date:
-            wheres.append(f"date <= '{end_date.format('YYYY-MM-DD')}'")
+            wheres.append("date <= @end")
+            query_parameters.append(bigquery.ScalarQueryParameter('end', 'DATE', end_date.format('YYYY-MM-DD')))
         where_clause = ' AND '.join(wheres)
         where_clause = 'WHERE ' + where_clause if where_clause else ''
-        query = dedent(f"""
-            SELECT *
-            FROM stock.{info_type}
-            {where_clause}
-        """)
+        query = f"SELECT {self._select_clause(columns)} FROM stock.{info_type} {where_clause}"
         table = self.get_table_if_exists(info_type)
-        df = self.client.query(query).to_dataframe(dtypes=self._extract_dtypes(table))
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters, use_query_cache=True)
+        dfs = self.client.query(query, job_config=job_config).result().to_dataframe_iterable(
+            bqstorage_client=self.bqstorage_client, dtypes=self._extract_dtypes(table, columns))
 
-        return df
+        return dfs
 
     def save_daily_info_all(self, info_type, codeinfo_df, write_disposition=bigquery.WriteDisposition.WRITE_EMPTY,
                             start_date=None, end_date=None):
-        all_table_names = [x.table_id for x in self.client.list_tables(self.dataset_ref)]
-        table_names = [f"{info_type}_{data['itemcode']}_{data['market']}" for index, data in codeinfo_df.iterrows()]
-        table_names = [x for x in table_names if x in all_table_names]
-        where_clause = ' AND '.join([
-            f"date {'>=' if i == 0 else '<='} '{x.format('YYYY-MM-DD')}'"
-            for i, x in enumerate([start_date, end_date]) if x])
-        where_clause = 'WHERE ' + where_clause if where_clause else ''
-        query = 'UNION ALL'.join([dedent(f"""
-            SELECT *
-            FROM stock.{table_name}
-            {where_clause}
-        """) for table_name in table_names])
-
         result_table_name = f'{info_type}_all'
-        job_config = bigquery.QueryJobConfig(write_disposition=write_disposition)
         table_ref = bigquery.TableReference(self.dataset_ref, result_table_name)
+        self.flush_daily_info(info_type.split('_info')[0])
+        if self.get_table_if_exists(info_type):
+            # 아직 이전되지 않은 종목도 결과에 포함되도록 먼저 통합 테이블로 옮긴다
+            self._migrate_items(info_type, zip(codeinfo_df['itemcode'], codeinfo_df['market']))
+            # 조합 조건만으로는 클러스터 pruning 이 되지 않으므로 컬럼별 조건을 함께 건다
+            wheres = [
+                "itemcode IN UNNEST(@itemcodes)", "market IN UNNEST(@markets)",
+                "CONCAT(CAST(itemcode AS STRING), '_', CAST(market AS STRING)) IN UNNEST(@items)",
+            ]
+            itemcodes, markets = codeinfo_df['itemcode'].astype(str), codeinfo_df['market'].astype(str)
+            items = itemcodes + '_' + markets
+            query_parameters = [
+                bigquery.ArrayQueryParameter('itemcodes', 'STRING', itemcodes.unique().tolist()),
+                bigquery.ArrayQueryParameter('markets', 'STRING', markets.unique().tolist()),
+                bigquery.ArrayQueryParameter('items', 'STRING', items.unique().tolist()),
+            ]
+            if start_date:
+                wheres.append("date >= @start")
+                query_parameters.append(
+                    bigquery.ScalarQueryParameter('start', 'DATE', start_date.format('YYYY-MM-DD')))
+            if end_date:
+                wheres.append("date <= @end")
+                query_parameters.append(bigquery.ScalarQueryParameter('end', 'DATE', end_date.format('YYYY-MM-DD')))
+            query = f"SELECT * FROM stock.{info_type} WHERE {' AND '.join(wheres)}"
+            self._query_to_table(query, table_ref, write_disposition, query_parameters)
+            self._invalidate_table_cache(result_table_name)
+            return table_ref
+
+        # 통합 테이블이 아직 없으면 기존 종목별 테이블들을 합친다
+        all_table_names = self._list_table_names()
+        table_names = info_type + '_' + codeinfo_df['itemcode'].astype(str) + '_' + codeinfo_df['market'].astype(str)
+        table_names = table_names[table_names.isin(all_table_names)].tolist()
+        wheres = []
+        query_parameters = []
+        if start_date:
+            wheres.append("date >= @start")
+            query_parameters.append(bigquery.ScalarQueryParameter('start', 'DATE', start_date.format('YYYY-MM-DD')))
+        if end_date:
+            wheres.append("date <= @end")
+            query_parameters.append(bigquery.ScalarQueryParameter('end', 'DATE', end_date.format('YYYY-MM-DD')))
+        where_clause = 'WHERE ' + ' AND '.join(wheres) if wheres else ''
+        queries = [
+            ' UNION ALL '.join(
+                f"SELECT * FROM stock.{table_name} {where_clause}"
+                for table_name in table_names[i:i + self.union_tables_per_query])
+            for i in range(0, len(table_names), self.union_tables_per_query)]
+        if not queries:
+            return table_ref
+
+        # 스테이징 테이블에 chunk 단위 UNION ALL 결과를 모은 뒤 한 번의 copy job 으로 결과 테이블을 교체한다.
+        # 중간에 실패해도 결과 테이블은 그대로 남는다.
+        stage_ref = bigquery.TableReference(self.dataset_ref, f'{result_table_name}_stage_{uuid.uuid4().hex}')
+        try:
+            self._query_to_table(queries[0], stage_ref, bigquery.WriteDisposition.WRITE_TRUNCATE, query_parameters)
+            stage_table = bigquery.Table(stage_ref)
+            stage_table.expires = datetime.now(timezone.utc) + timedelta(hours=1)
+            self.client.update_table(stage_table, ['expires'])
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [
+                    executor.submit(
+                        self._query_to_table, query, stage_ref, bigquery.WriteDisposition.WRITE_APPEND,
+                        query_parameters)
+                    for query in queries[1:]]
+                for future in futures:
+                    future.result()
+            job_config = bigquery.CopyJobConfig(write_disposition=write_disposition)
+            self.client.copy_table(stage_ref, table_ref, job_config=job_config).result()
+        finally:
+            self.client.delete_table(stage_ref, not_found_ok=True)
+        self._invalidate_table_cache(result_table_name)
+
+        return table_ref
+
+    def _query_to_table(self, query, table_ref, write_disposition, query_parameters=()):
+        job_config = bigquery.QueryJobConfig(
+            write_disposition=write_disposition, query_parameters=list(query_parameters))
         job_config.destination = table_ref
         job = self.client.query(query, job_config=job_config)
         job.result()
 
-        return table_ref
-
-    def _get_daily_info(self, info_type, itemcode_info, start_date=None, end_date=None):
+    def _get_daily_info(self, info_type, itemcode_info, start_date=None, end_date=None, columns=None):
         itemcode, itemname, market = itemcode_info
-        table = self.get_table_if_exists(f'{info_type}_info_{itemcode}_{market}')
-        daily_info = self.client.list_rows(table).to_dataframe(dtypes=self._extract_dtypes(table))
-        daily_info = daily_info.set_index('date').sort_index()
-        daily_info.index = pd.to_datetime(daily_info.index)
+        self.flush_daily_info(info_type)
+        if columns and 'date' not in columns:
+            columns = ['date'] + list(columns)
+        wheres = []
+        query_parameters = []
         if start_date:
-            daily_info = daily_info.loc[start_date:]
+            wheres.append("date >= @start")
+            query_parameters.append(bigquery.ScalarQueryParameter('start', 'DATE', pd.Timestamp(start_date).date()))
         if end_date:
-            daily_info = daily_info.loc[:end_date]
+            wheres.append("date <= @end")
+            query_parameters.append(bigquery.ScalarQueryParameter('end', 'DATE', pd.Timestamp(end_date).date()))
+
+        table_name = f'{info_type}_info'
+        # 아직 통합 테이블로 이전되지 않은 종목은 기존 종목별 테이블에서 읽는다
+        legacy_name = self._unmigrated_legacy_tables(table_name, [(itemcode, market)]).get((str(itemcode), str(market)))
+        legacy_table = self.get_table_if_exists(legacy_name) if legacy_name else None
+        daily_info = None
+        if legacy_table:
+            daily_info = self._query_daily_info(legacy_table, wheres, query_parameters, columns)
+        else:
+            table = self.get_table_if_exists(table_name)
+            if table:
+                daily_info = self._query_daily_info(
+                    table, wheres + ["itemcode = @itemcode", "market = @market"],
+                    query_parameters + [
+                        bigquery.ScalarQueryParameter('itemcode', 'STRING', itemcode),
+                        bigquery.ScalarQueryParameter('market', 'STRING', market),
+                    ], columns, excepts=('itemcode', 'market'))
+        if daily_info is None:
+            daily_info = pd.DataFrame({'date': pd.Series(dtype='datetime64[ns]')}).set_index('date')
 
         return daily_info
 
+    def _query_daily_info(self, table, wheres, query_parameters, columns=None, excepts=()):
+        # excepts 는 columns 를 지정하지 않았을 때 결과에서 뺄 컬럼 (통합 테이블의 itemcode, market)
+        field_names = [field.name for field in table.schema]
+        if columns:
+            columns = [x for x in columns if x in field_names]
+            excepts = ()
+        else:
+            excepts = [x for x in excepts if x in field_names]
+        where_clause = 'WHERE ' + ' AND '.join(wheres) if wheres else ''
+        query = f"SELECT {self._select_clause(columns, excepts)} FROM stock.{table.table_id} {where_clause}"
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters, use_query_cache=True)
+        dtypes = {name: dtype for name, dtype in self._extract_dtypes(table, columns).items() if name not in excepts}
+        daily_info = self.client.query(query, job_config=job_config).result().to_dataframe(
+            bqstorage_client=self.bqstorage_client, dtypes=dtypes)
+        daily_info.sort_values('date', kind='stable', inplace=True)
+        daily_info.set_index('date', inplace=True)
+
+        return daily_info
+
+    def _buffer_daily_info(self, info_type, itemcode_info, df, write_disposition):
+        itemcode, itemname, market = itemcode_info
+        df = df.assign(itemcode=itemcode, market=market)
+        key = (info_type, write_disposition)
+        with self._buffer_lock:
+            dfs = self._daily_info_buffers.setdefault(key, [])
+            dfs.append(df)
+            _buffered_workers.add(self)
+            flush = sum(len(x) for x in dfs) >= self.flush_rows_threshold
+            if flush:
+                del self._daily_info_buffers[key]
+        if flush:
+            return self._flush_daily_info_buffers({key: dfs})[0]
+
+    def _flush_daily_info(self, info_type, dfs, write_disposition):
+        table_name = f'{info_type}_info'
+        keys = ['itemcode', 'market', 'date']
+        # 같은 날을 여러 번 저장해도 중복되지 않도록 (itemcode, market, date) 기준으로 마지막 행만 남긴다
+        df = pd.concat(dfs, copy=False, ignore_index=True).drop_duplicates(keys, keep='last')
+        # 종목별 테이블에 남아 있는 과거 데이터가 가려지지 않도록 처음 저장하는 종목은 먼저 이전한다
+        self._migrate_items(table_name, df[['itemcode', 'market']].drop_duplicates().itertuples(index=False))
+        if self.get_table_if_exists(table_name):
+            return self._merge_dataframe(table_name, df, keys, write_disposition)
+
+        table_ref = bigquery.TableReference(self.dataset_ref, table_name)
+        # 일 단위 파티션은 4000개 제한에 걸리므로 월 단위로 파티셔닝
+        job_config = bigquery.LoadJobConfig(
+            schema=self._extract_schema(df), write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            source_format=bigquery.SourceFormat.PARQUET,
+            time_partitioning=self._daily_info_partitioning(),
+            clustering_fields=['itemcode', 'market'],
+        )
+        job = self._load_dataframe(df, table_ref, job_config)
+        job.result()
+        self._invalidate_table_cache(table_name)
+        self.logger.info(f'{table_name} 테이블에 {info_type} 정보 {len(df)}건 저장')
+        if 'date' in df:
+            start_date, end_date = df['date'].min(), df['date'].max()
+            self.logger.info(f'start_date: {start_date}, end_date: {end_date}')
+
+        return table_ref
+
+    def _daily_info_partitioning(self):
+        return bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.MONTH, field='date')
+
+    def migrate_daily_info(self, info_type):
+        # 종목별 테이블(daily_items_info_{itemcode}_{market})을 통합 테이블로 옮긴다.
+        # 저장/조회 시에도 종목 단위로 필요할 때 옮기므로 한 번에 모두 옮기고 싶을 때만 호출하면 된다
+        table_name = f'{info_type}_info'
+        items = []
+        for legacy_name in self._list_table_names():
+            if not legacy_name.startswith(f'{table_name}_') or '_stage_' in legacy_name:
+                continue
+            parts = legacy_name[len(table_name) + 1:].rsplit('_', 1)
+            if len(parts) == 2:
+                items.append(tuple(parts))
+
+        return self._migrate_items(table_name, sorted(items))
+
+    def _migrated_items_table_name(self, table_name):
+        return f'{table_name}_migrated'
+
+    def _migrated_items(self, table_name):
+        with self._cache_lock:
+            if table_name in self._migrated_items_cache:
+                return self._migrated_items_cache[table_name]
+        migrated_table_name = self._migrated_items_table_name(table_name)
+        migrated = set()
+        if self.get_table_if_exists(migrated_table_name):
+            rows = self.client.query_and_wait(f"SELECT itemcode, market FROM stock.{migrated_table_name}")
+            migrated = {(row.itemcode, row.market) for row in rows}
+        with self._cache_lock:
+            self._migrated_items_cache[table_name] = migrated
+
+        return migrated
+
+    def _unmigrated_legacy_tables(self, table_name, items):
+        all_table_names = self._list_table_names()
+        legacy_tables = dict()
+        for itemcode, market in items:
+            item = (str(itemcode), str(market))
+            legacy_name = f'{table_name}_{item[0]}_{item[1]}'
+            if legacy_name in all_table_names:
+                legacy_tables[item] = legacy_name
+        if legacy_tables:
+            migrated = self._migrated_items(table_name)
+            legacy_tables = {item: x for item, x in legacy_tables.items() if item not in migrated}
+
+        return legacy_tables
+
+    def _migrate_items(self, table_name, items):
+        items = list(items)
+        if not self._unmigrated_legacy_tables(table_name, items):
+            return []
+
+        # 컬럼 추가가 동시에 일어나면 충돌하므로 순차로 옮긴다
+        with self._migrate_lock:
+            with self._cache_lock:
+                self._migrated_items_cache.pop(table_name, None)
+            legacy_tables = self._unmigrated_legacy_tables(table_name, items)
+            for (itemcode, market), legacy_name in legacy_tables.items():
+                self._migrate_item(table_name, legacy_name, itemcode, market)
+
+        return list(legacy_tables.values())
+
+    def _migrate_item(self, table_name, legacy_name, itemcode, market):
+        table_ref = bigquery.TableReference(self.dataset_ref, table_name)
+        field_names = {field.name for field in self.get_table_if_exists(legacy_name).schema}
+        selects = ['L.*']
+        query_parameters = [
+            bigquery.ScalarQueryParameter('itemcode', 'STRING', itemcode),
+            bigquery.ScalarQueryParameter('market', 'STRING', market),
+        ]
+        for name in ('itemcode', 'market'):
+            if name not in field_names:
+                selects.append(f'@{name} AS {name}')
+        # 이전 기록을 남기기 전에 실패해도 다시 옮길 때 중복되지 않도록 이미 있는 날짜는 건너뛴다
+        where_clause = ''
+        if self.get_table_if_exists(table_name):
+            where_clause = f"""WHERE NOT EXISTS (
+                SELECT 1 FROM stock.{table_name} T
+                WHERE T.itemcode = @itemcode AND T.market = @market AND T.date = L.date)"""
+        job_config = bigquery.QueryJobConfig(
+            destination=table_ref, write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            time_partitioning=self._daily_info_partitioning(), clustering_fields=['itemcode', 'market'],
+            schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
+            query_parameters=query_parameters)
+        self.client.query(
+            f"SELECT {', '.join(selects)} FROM stock.{legacy_name} L {where_clause}", job_config=job_config).result()
+        self._invalidate_table_cache(table_name)
+
+        migrated_table_name = self._migrated_items_table_name(table_name)
+        migrated_table = bigquery.Table(
+            bigquery.TableReference(self.dataset_ref, migrated_table_name),
+            schema=[bigquery.SchemaField('itemcode', 'STRING'), bigquery.SchemaField('market', 'STRING')])
+        self.client.create_table(migrated_table, exists_ok=True)
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+        self.client.query(
+            f"INSERT INTO stock.{migrated_table_name} (itemcode, market) VALUES (@itemcode, @market)",
+            job_config=job_config).result()
+        self._invalidate_table_cache(migrated_table_name)
+        with self._cache_lock:
+            self._migrated_items_cache.pop(table_name, None)
+        self.logger.info(f'{legacy_name} 테이블을 {table_name} 테이블로 이전')
+
+    def _select_clause(self, columns, excepts=()):
+        if columns:
+            return ', '.join(f'`{x}`' for x in columns)
+
+        return f"* EXCEPT({', '.join(f'`{x}`' for x in excepts)})" if excepts else '*'
+
+    def _concat_dataframes(self, dfs, dtypes):
+        dfs = list(dfs)
+        if not dfs:
+            return pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in dtypes.items()})
+
+        return pd.concat(dfs, copy=False, ignore_index=True)
+
     def _extract_schema(self, df):
         schema = []
-        for column_name, dtype in dict(df.dtypes).items():
-            type_map = {
-                np.dtype('object'): bigquery.SchemaField(column_name, 'STRING'),
-                np.dtype('int32'): bigquery.SchemaField(column_name, 'INTEGER'),
-                np.dtype('int64'): bigquery.SchemaField(column_name, 'INTEGER'),
-                np.dtype('float64'): bigquery.SchemaField(column_name, 'FLOAT'),
-                np.dtype('datetime64[ns]'): bigquery.SchemaField(column_name, 'DATE'),
-                pd.DatetimeTZDtype(tz='UTC'): bigquery.SchemaField(column_name, 'DATE')
-            }
-            schema.append(type_map[dtype])
+        for column_name, dtype in df.dtypes.items():
+            if isinstance(dtype, pd.DatetimeTZDtype):
+                field_type = 'DATE'
+            else:
+                field_type = BQ_TYPE_MAP[dtype]
+            schema.append(bigquery.SchemaField(column_name, field_type))
 
         return schema
 
-    def _extract_dtypes(self, table):
-        dtypes = dict()
-        type_map = {
-            'STRING': np.dtype('object'),
-            'INTEGER': np.dtype('int64'),
-            'FLOAT': np.dtype('float64'),
-            'DATE': np.dtype('datetime64[ns]'),
-        }
-        for field in table.schema:
-            dtypes[field.name] = type_map[field.field_type]
-        return dtypes
-
-    def _save_info(self, info_type, table_name, df, write_disposition=bigquery.WriteDisposition.WRITE_EMPTY):
+    def _extract_dtypes(self, table, columns=None):
+        # 스키마가 바뀌면 etag 도 바뀌므로 (테이블, etag) 로 캐시하고 columns 가 없으면 캐시된 dict 를 그대로 돌려준다.
+        # 돌려받은 dict 는 수정하지 않는다
+        key = (table.full_table_id, table.etag)
+        with self._cache_lock:
+            dtypes = self._dtypes_cache.get(key) if table.etag else None
+        if dtypes is None:
+            dtypes = {field.name: DTYPE_MAP[field.field_type] for field in table.schema}
+            if table.etag:
+                with self._cache_lock:
+                    self._dtypes_cache[key] = dtypes
+        if not columns:
+            return dtypes
+
+        return {name: dtype for name, dtype in dtypes.items() if name in columns}
+
+    def _save_info(self, info_type, table_name, df, write_disposition=bigquery.WriteDisposition.WRITE_EMPTY,
+                   time_partitioning=None, clustering_fields=None):
         table_ref = bigquery.TableReference(self.dataset_ref, table_name)
         schema = self._extract_schema(df)
-        try:
-            table = self.client.get_table(table_ref)
-        except NotFound:
-            table = bigquery.Table(table_ref, schema=schema)
-            table = self.client.create_table(table)
         job_config = bigquery.LoadJobConfig(
-            schema=schema, write_disposition=write_disposition
+            schema=schema, write_disposition=write_disposition,
+            create_disposition=bigquery.CreateDisposition.CREATE_IF_NEEDED,
+            source_format=bigquery.SourceFormat.PARQUET,
+            time_partitioning=time_partitioning, clustering_fields=clustering_fields,
         )
         try:
-            job = self.client.load_table_from_dataframe(df, table, job_config=job_config)
+            job = self._load_dataframe(df, table_ref, job_config)
         except Conflict:
-            self.logger.info(f'{table.table_id} 테이블이 이미 존재하여 SKIP')
+            self.logger.info(f'{table_ref.table_id} 테이블이 이미 존재하여 SKIP')
             return
         job.result()
-        self.logger.info(f'{table.table_id} 테이블에 {info_type} 정보 저장')
+        self._invalidate_table_cache(table_name)
+        self.logger.info(f'{table_ref.table_id} 테이블에 {info_type} 정보 저장')
         if 'date' in df:
             start_date, end_date = df['date'].min(), df['date'].max()
             self.logger.info(f'start_date: {start_date}, end_date: {end_date}')
 
-        return table
+        return table_ref
+
+    def _load_dataframe(self, df, table_ref, job_config):
+        # DATE 컬럼은 8바이트 timestamp 대신 4바이트 date32 로 변환해 parquet 파일을 직접 만든다
+        # 값이 모두 None 인 컬럼은 null 타입으로 추론되므로 모든 컬럼을 스키마 타입으로 맞춘다
+        # tz 가 있는 값은 UTC 로 바꾸면 날짜가 하루 밀리므로(Asia/Seoul 자정 -> 전날) 현지 날짜를 그대로 쓴다
+        local_dates = {
+            column_name: df[column_name].dt.tz_localize(None)
+            for column_name, dtype in df.dtypes.items() if isinstance(dtype, pd.DatetimeTZDtype)}
+        arrow_table = pa.Table.from_pandas(df.assign(**local_dates), preserve_index=False)
+        columns = []
+        for field in job_config.schema:
+            column = arrow_table.column(field.name)
+            arrow_type = ARROW_TYPE_MAP[field.field_type]
+            if column.type != arrow_type:
+                # timestamp -> date32 는 시간 부분을 버리므로 safe=False
+                column = pc.cast(column, arrow_type, safe=field.field_type != 'DATE')
+            columns.append(column)
+        arrow_table = pa.Table.from_arrays(columns, names=[x.name for x in job_config.schema])
+        buffer = io.BytesIO()
+        pq.write_table(arrow_table, buffer, compression='ZSTD')
+        buffer.seek(0)
+
+        return self.client.load_table_from_file(buffer, table_ref, job_config=job_config)
+
+    def _merge_keys(self, schema):
+        # 종목별 일간 정보를 모은 통합 테이블은 (itemcode, market, date), 그 외 테이블은 (date, itemname) 으로 구분
+        names = {field.name for field in schema}
+        if {'itemcode', 'market', 'date'} <= names:
+            return ('itemcode', 'market', 'date')
+
+        return ('date', 'itemname')
 
     def delete_duplicated_rows(self, table_name, start_date_str, codeinfo_df=None):
         if not self.get_table_if_exists(table_name):
             return
 
         itemnames_clause=''
+        query_parameters = [bigquery.ScalarQueryParameter('start', 'DATE', start_date_str)]
         if codeinfo_df is not None:
-            itemnames_str = ', '.join([f"'{x}'" for x in codeinfo_df['itemname'].unique().tolist()])
-            itemnames_clause = f"AND itemname in ({itemnames_str})"
-        job = self.client.query(dedent(f"""
-            DELETE
-            FROM stock.{table_name}
-            WHERE date >= '{start_date_str}'
-                {itemnames_clause}
-        """))
+            itemnames_clause = "AND itemname IN UNNEST(@itemnames)"
+            query_parameters.append(bigquery.ArrayQueryParameter(
+                'itemnames', 'STRING', codeinfo_df['itemname'].unique().tolist()))
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+        job = self.client.query(
+            f"DELETE FROM stock.{table_name} WHERE date >= @start {itemnames_clause}", job_config=job_config)
         job.result()
         self.logger.info(f'{table_name} 테이블에서 {start_date_str} 이후 데이터 삭제 ({codeinfo_df})')
+
+    def upsert_daily_info(self, table_name, df, keys=None):
+        # 버퍼에 남은 이전 행이 나중에 저장되면서 이번 값을 덮어쓰지 않도록 먼저 저장한다
+        self.flush_daily_info(table_name.split('_info')[0])
+        table = self.get_table_if_exists(table_name)
+        if keys is None:
+            keys = self._merge_keys(table.schema if table else self._extract_schema(df))
+        # 같은 키의 행이 여러 개면 MERGE 가 실패하므로 마지막 행만 남긴다
+        df = df.drop_duplicates(list(keys), keep='last')
+        if not table:
+            info_type = table_name.split('_info')[0]
+            if tuple(keys) == ('itemcode', 'market', 'date'):
+                # 통합 일간 테이블은 _flush_daily_info 에서 만드는 것과 같은 파티션/클러스터로 만든다
+                return self._save_info(
+                    info_type, table_name, df, bigquery.WriteDisposition.WRITE_APPEND,
+                    time_partitioning=self._daily_info_partitioning(), clustering_fields=['itemcode', 'market'])
+            return self._save_info(info_type, table_name, df, bigquery.WriteDisposition.WRITE_APPEND)
+
+        return self._merge_dataframe(table_name, df, keys)
+
+    def _merge_dataframe(self, table_name, df, keys, write_disposition=bigquery.WriteDisposition.WRITE_APPEND):
+        # WRITE_APPEND: 같은 키는 갱신하고 나머지는 추가
+        # WRITE_EMPTY: 이미 있는 키는 건드리지 않고 새 키만 추가
+        # WRITE_TRUNCATE: WRITE_APPEND 에 더해 df 에 포함된 종목의 나머지 행은 삭제
+        schema = self._extract_schema(df)
+        stage_ref = bigquery.TableReference(self.dataset_ref, f'{table_name}_stage_{uuid.uuid4().hex}')
+        # 작업이 중간에 실패해도 스테이징 테이블이 남지 않도록 만료 시간을 지정
+        stage_table = bigquery.Table(stage_ref, schema=schema)
+        stage_table.expires = datetime.now(timezone.utc) + timedelta(hours=1)
+        self.client.create_table(stage_table)
+        try:
+            job_config = bigquery.LoadJobConfig(
+                schema=schema, write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+                source_format=bigquery.SourceFormat.PARQUET
+            )
+            job = self._load_dataframe(df, stage_ref, job_config)
+            job.result()
+
+            columns = [f'`{x.name}`' for x in schema]
+            clauses = []
+            updates = ', '.join(f'{x} = S.{x}' for x in columns if x.strip('`') not in keys)
+            if updates and write_disposition != bigquery.WriteDisposition.WRITE_EMPTY:
+                clauses.append(f'WHEN MATCHED THEN UPDATE SET {updates}')
+            clauses.append(
+                f"WHEN NOT MATCHED THEN INSERT ({', '.join(columns)}) VALUES ({', '.join(f'S.{x}' for x in columns)})")
+            query_parameters = []
+            scope_keys = [x for x in keys if x != 'date']
+            if write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE and scope_keys:
+                # 컬럼별 IN 조건은 클러스터 pruning 용, CONCAT 조건은 정확한 (itemcode, market) 조합 확인용
+                field_types = {x.name: x.field_type for x in schema}
+                scope_wheres = []
+                for i, key in enumerate(scope_keys):
+                    scope_wheres.append(f'T.`{key}` IN UNNEST(@scope_{i})')
+                    query_parameters.append(bigquery.ArrayQueryParameter(
+                        f'scope_{i}', field_types[key], df[key].unique().tolist()))
+                if len(scope_keys) > 1:
+                    scope_values = df[scope_keys[0]].astype(str)
+                    for key in scope_keys[1:]:
+                        scope_values = scope_values + '_' + df[key].astype(str)
+                    scope_expr = ", '_', ".join(f'CAST(T.`{x}` AS STRING)' for x in scope_keys)
+                    scope_wheres.append(f'CONCAT({scope_expr}) IN UNNEST(@scope)')
+                    query_parameters.append(
+                        bigquery.ArrayQueryParameter('scope', 'STRING', scope_values.unique().tolist()))
+                clauses.append(f"WHEN NOT MATCHED BY SOURCE AND {' AND '.join(scope_wheres)} THEN DELETE")
+            on_clause = ' AND '.join(f'T.`{x}` = S.`{x}`' for x in keys)
+            job = self.client.query(
+                f"MERGE stock.{table_name} T USING stock.{stage_ref.table_id} S ON {on_clause} {' '.join(clauses)}",
+                job_config=bigquery.QueryJobConfig(query_parameters=query_parameters))
+            job.result()
+        finally:
+            self.client.delete_table(stage_ref, not_found_ok=True)
+        self._invalidate_table_cache(table_name)
+        self.logger.info(f'{table_name} 테이블에 {len(df)}건 병합')
+
+        return bigquery.TableReference(self.dataset_ref, table_name)